@@ -1,15 +1,31 @@
 import os
+import re
+import json
+import hashlib
+import queue
+import asyncio
+import tempfile
+import threading
+import zipfile
 from io import BytesIO
 from datetime import datetime
+from xml.sax.saxutils import escape
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import streamlit as st
 import dropbox
-from dropbox.exceptions import AuthError, ApiError
+from dropbox.exceptions import AuthError, ApiError, RateLimitError, InternalServerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
-import fitz  # PyMuPDF
+from pdf_pages import PDF_BACKENDS, open_pdf, extract_page_range, fastest_pdf_backend
 from docx import Document as DocReader
-from docx import Document as DocWriter
-from openai import OpenAI
+from lxml import etree
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import tiktoken
+import diskcache
 
 # ===== Secrets =====
 DBX_APP_KEY = st.secrets["dropbox"]["app_key"]
@@ -19,18 +35,87 @@ OPENAI_API_KEY = st.secrets["openai"]["api_key"]
 
 # 初始展示路径仍然用 "/"，对用户友好；内部会自动转成 "" 再调 API
 DEFAULT_START_FOLDER = "/"
+DOWNLOAD_WORKERS = 16  # 并发下载线程数
+# 长 PDF 按页段分给多个进程提取（PyMuPDF 不支持多线程，只能多进程）
+PDF_PARALLEL_MIN_PAGES = 40  # 页数超过此值才并行，短文档串行更快
+PDF_WORKERS = min(8, os.cpu_count() or 1)
+# 只用 fork：spawn/forkserver 会在子进程里把本 Streamlit 脚本当作 __main__ 重新执行一遍
+PDF_PARALLEL = PDF_WORKERS > 1 and "fork" in multiprocessing.get_all_start_methods()
 
 PROMPT_PATH = "Prompt.txt"
 MODEL_NAME = "gpt-4-1106-preview"  # 如报模型不可用可换 "gpt-4o-mini"
-client = OpenAI(api_key=OPENAI_API_KEY)
+GPT_CONCURRENCY = 8  # 同时在途的 GPT 请求上限（GPT 消费者个数）
+PIPELINE_QUEUE_SIZE = 8  # 流水线各段之间的队列长度，上游太快时会在这里等待
+# 多份大纲打包进同一个请求，base prompt 只计费一次
+PACK_TOKEN_BUDGET = 12000  # 每个请求中大纲正文的 token 上限（不含 base prompt）
+PACK_MAX_FILES = 4  # 每个请求最多几份大纲，避免输出超出模型的回复长度
+# 单份大纲超长时只保留首尾（课程描述在前、评分标准常在末尾）
+SYLLABUS_MAX_TOKENS = 12000
+MAX_PROMPT_TOKENS = 120000  # 模型上下文 128k，留出回复的空间
+RESULT_CACHE_DIR = ".eeq_cache"  # 每个文件的 GPT 结果按 (文件内容, prompt) 落盘缓存
+
+# ===== OpenAI =====
+# 常驻事件循环线程：缓存的 AsyncOpenAI 连接池绑定在这个循环上，跨 rerun 复用
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="eeq-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client() -> AsyncOpenAI:
+    # HTTP/2 keep-alive 连接池，所有请求共用 TLS 连接；429/5xx 由 SDK 指数退避重试
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        ),
+        max_retries=5,
+    )
+
+def run_async(coro):
+    """在常驻事件循环上执行协程并等待结果。"""
+    fut = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return fut.result()
+    finally:
+        fut.cancel()  # 脚本被 rerun/stop 打断时不让协程在后台继续跑
+
+def start_job(coro, events, total: int) -> dict:
+    """在常驻事件循环上启动长任务但不等待：任务不随 rerun 取消，进度记在返回的 job 里。"""
+    return {
+        "future": asyncio.run_coroutine_threadsafe(coro, get_event_loop()),
+        "events": events,
+        "total": total,
+        "done": 0,
+        "parsed": [],
+    }
+
+def wait_job(job, on_event):
+    """等待 job 结束，期间把协程通过 events 队列发出的 (kind, value) 在当前脚本线程里交给 on_event，
+    回调里可以直接用 st.*。脚本被 rerun 打断时任务照常在后台跑，下一轮接着等。"""
+    fut, events = job["future"], job["events"]
+    while not fut.done():
+        try:
+            on_event(*events.get(timeout=0.1))
+        except queue.Empty:
+            pass
+    while not events.empty():
+        on_event(*events.get_nowait())
+
+client = get_openai_client()
 
 # ===== Dropbox =====
+# 整个进程共用一个客户端（SDK 会自行刷新 access token），避免每次调用都重新鉴权、查账号
+@st.cache_resource(ttl=3000, show_spinner=False)
 def get_dbx() -> dropbox.Dropbox:
     base = dropbox.Dropbox(
         oauth2_refresh_token=DBX_REFRESH_TOKEN,
         app_key=DBX_APP_KEY,
         app_secret=DBX_APP_SECRET,
         timeout=60,
+        session=dropbox.create_session(max_connections=DOWNLOAD_WORKERS),  # 连接池与下载线程数一致
     )
     # 绑定到账号的根命名空间，避免在团队空间/共享空间下看不到子层级
     try:
@@ -42,6 +127,14 @@ def get_dbx() -> dropbox.Dropbox:
         pass
     return base
 
+def with_dbx(fn):
+    """用缓存的客户端调用 fn(dbx)；认证失败时先清掉缓存，再用新客户端重试一次。"""
+    try:
+        return fn(get_dbx())
+    except AuthError:
+        get_dbx.clear()
+        return fn(get_dbx())
+
 # 把显示路径转换为 Dropbox API 路径
 def to_api_path(display_path: str) -> str:
     """用户看到的根目录是 '/', 但 Dropbox API 需要传 ''。其他路径保持原样。"""
@@ -49,129 +142,641 @@ def to_api_path(display_path: str) -> str:
         return ""
     return display_path
 
-def list_dropbox_folders(folder_path: str = "/"):
-    try:
-        dbx = get_dbx()
-        api_path = to_api_path(folder_path)
-
+# 整个 Dropbox 目录树只递归列一次，存在 session_state["tree"]（path_lower -> 元数据）；
+# 翻目录只在本地过滤，不再逐层请求
+def apply_tree_entries(tree, entries):
+    for entry in entries:
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            tree.pop(entry.path_lower, None)
+            # 删掉的是文件夹时，其下条目未必逐个出现在变更里
+            prefix = entry.path_lower + "/"
+            for p in [p for p in tree if p.startswith(prefix)]:
+                del tree[p]
+        else:
+            tree[entry.path_lower] = entry
+
+def list_all_pages(dbx, result, tree):
+    """把 result 及其后续分页都合并进 tree，返回最后一页的游标。"""
+    while True:
+        apply_tree_entries(tree, result.entries)
+        if not result.has_more:
+            return result.cursor
+        result = dbx.files_list_folder_continue(result.cursor)
+
+def load_tree(refresh: bool = False):
+    """首次递归列出整个 Dropbox；refresh=True 时用上次的游标只拉取之后的增删改。"""
+    def _full(dbx):
+        tree = {}
         result = dbx.files_list_folder(
-            api_path,
-            recursive=False,
+            "",
+            recursive=True,
             include_mounted_folders=True,
             include_non_downloadable_files=True,
         )
+        return tree, list_all_pages(dbx, result, tree)
+
+    def _incremental(dbx):
+        tree = dict(st.session_state.tree)
+        try:
+            result = dbx.files_list_folder_continue(st.session_state.tree_cursor)
+        except ApiError as e:
+            # 游标过期（reset）时只能重新全量列一遍
+            if isinstance(e.error, dropbox.files.ListFolderContinueError) and e.error.is_reset():
+                return _full(dbx)
+            raise
+        return tree, list_all_pages(dbx, result, tree)
 
-        folders = []
-        while True:
-            for entry in result.entries:
-                if isinstance(entry, dropbox.files.FolderMetadata):
-                    folders.append((entry.name, entry.path_lower))
-                elif hasattr(entry, "is_downloadable") and (not entry.is_downloadable):
-                    if hasattr(entry, "path_lower") and hasattr(entry, "name"):
-                        folders.append((entry.name, entry.path_lower))
-            if result.has_more:
-                result = dbx.files_list_folder_continue(result.cursor)
-            else:
-                break
-
-        folders.sort(key=lambda x: x[0].lower())
-        return folders
-    except AuthError:
-        st.error("Dropbox 认证失败，请检查 refresh token 与应用权限。"); st.stop()
-    except ApiError as e:
-        st.error(f"Dropbox API 错误：{e}"); st.stop()
-    except Exception as e:
-        st.error(f"读取文件夹失败：{e}"); st.stop()
-
-def list_dropbox_files(folder_path: str):
     try:
-        dbx = get_dbx()
-        api_path = to_api_path(folder_path)
-        result = dbx.files_list_folder(
-            api_path,
-            recursive=False,
-            include_mounted_folders=True,
-            include_non_downloadable_files=True,
-        )
-
-        files = []
-        while True:
-            for entry in result.entries:
-                if isinstance(entry, dropbox.files.FileMetadata):
-                    name_l = entry.name.lower()
-                    if name_l.endswith(".pdf") or name_l.endswith(".docx"):
-                        files.append((entry.name, entry.path_lower))
-            if result.has_more:
-                result = dbx.files_list_folder_continue(result.cursor)
+        with st.spinner("Loading Dropbox folder tree..."):
+            if refresh and "tree_cursor" in st.session_state:
+                st.session_state.tree, st.session_state.tree_cursor = with_dbx(_incremental)
             else:
-                break
-
-        files.sort(key=lambda x: x[0].lower())
-        return files
+                st.session_state.tree, st.session_state.tree_cursor = with_dbx(_full)
     except AuthError:
         st.error("Dropbox 认证失败，请检查 refresh token 与应用权限。"); st.stop()
     except ApiError as e:
         st.error(f"Dropbox API 错误：{e}"); st.stop()
     except Exception as e:
-        st.error(f"列出文件失败：{e}"); st.stop()
+        st.error(f"读取 Dropbox 目录失败：{e}"); st.stop()
+
+def tree_children(folder_path: str):
+    """folder_path 下一层的条目（不递归）。path_lower 全是小写，输入路径也要转小写再比。"""
+    if "tree" not in st.session_state:
+        load_tree()
+    prefix = to_api_path(folder_path).lower().rstrip("/") + "/"
+    return [
+        entry for p, entry in st.session_state.tree.items()
+        if p.startswith(prefix) and "/" not in p[len(prefix):]
+    ]
 
-def download_dropbox_files(files, selected_names):
-    try:
-        dbx = get_dbx()
-        selected = set(selected_names)
-        out = []
-        for name, path in files:
-            if name in selected:
-                _, res = dbx.files_download(path)
-                out.append((name, res.content))
-        return out
-    except AuthError:
-        st.error("Dropbox 认证失败（下载阶段）。"); st.stop()
-    except ApiError as e:
-        st.error(f"Dropbox API 错误：{e}"); st.stop()
-    except Exception as e:
-        st.error(f"下载失败：{e}"); st.stop()
+def list_dropbox_folders(folder_path: str = "/"):
+    folders = []
+    for entry in tree_children(folder_path):
+        if isinstance(entry, dropbox.files.FolderMetadata):
+            folders.append((entry.name, entry.path_lower))
+        elif hasattr(entry, "is_downloadable") and (not entry.is_downloadable):
+            folders.append((entry.name, entry.path_lower))
+    folders.sort(key=lambda x: x[0].lower())
+    return folders
+
+def list_dropbox_files(folder_path: str):
+    files = []
+    for entry in tree_children(folder_path):
+        if isinstance(entry, dropbox.files.FileMetadata):
+            name_l = entry.name.lower()
+            if name_l.endswith(".pdf") or name_l.endswith(".docx"):
+                files.append((entry.name, entry.path_lower))
+    files.sort(key=lambda x: x[0].lower())
+    return files
+
+# 429 / 5xx 时指数退避重试（SDK 自带的重试用尽后再兜底）
+@retry(
+    retry=retry_if_exception_type((RateLimitError, InternalServerError)),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+def download_dropbox_file(dbx, path, local_path):
+    # 直接流式写到本地文件，不在内存里拼出整个 res.content
+    dbx.files_download_to_file(local_path, path)
+    return local_path
 
 # ===== 本地文件处理 =====
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+W_P, W_T, W_TAB, W_PTAB, W_BR, W_CR, W_NO_BREAK_HYPHEN = (
+    f"{{{W_NS}}}{tag}" for tag in ("p", "t", "tab", "ptab", "br", "cr", "noBreakHyphen")
+)
+W_TYPE = f"{{{W_NS}}}type"
+DOCX_XML_PARSER = etree.XMLParser(resolve_entities=False)
+# 与 python-docx 的 Paragraph.text 一致：只取段落直属的 run 和超链接里的 run。
+# 文本框等嵌套内容（mc:Choice、mc:Fallback 各存一份）不取，否则文字会重复并粘进所在段落
+DOCX_PARAGRAPH_RUNS = etree.XPath("./w:r | ./w:hyperlink/w:r", namespaces={"w": W_NS})
+
+def docx_run_text(r) -> str:
+    # 只看 run 的直接子元素，规则同 python-docx 的 Run.text；分页符、分栏符不算文字
+    parts = []
+    for el in r:
+        if el.tag == W_T:
+            parts.append(el.text or "")
+        elif el.tag in (W_TAB, W_PTAB):
+            parts.append("\t")
+        elif el.tag == W_CR or (el.tag == W_BR and el.get(W_TYPE, "textWrapping") == "textWrapping"):
+            parts.append("\n")
+        elif el.tag == W_NO_BREAK_HYPHEN:
+            parts.append("-")
+    return "".join(parts)
+
+def docx_body_texts(xml: bytes):
+    """逐段取 word/document.xml 正文的文字，与 python-docx 的 doc.paragraphs 对应（不含表格）。"""
+    body = etree.fromstring(xml, DOCX_XML_PARSER).find(f"{{{W_NS}}}body")
+    for p in body.iterchildren(W_P):
+        yield "".join(docx_run_text(r) for r in DOCX_PARAGRAPH_RUNS(p))
+
+# src 可以是 bytes（本地上传），也可以是文件路径（Dropbox 下载的临时文件）
+def extract_text_from_docx(src):
+    # 快速路径：直接解析 zip 里的 word/document.xml，不构造 python-docx 的对象树
+    try:
+        with zipfile.ZipFile(src if isinstance(src, str) else BytesIO(src)) as z:
+            xml = z.read("word/document.xml")
+        return "\n".join(docx_body_texts(xml))
+    except (zipfile.BadZipFile, KeyError, AttributeError, etree.XMLSyntaxError):
+        pass
+    # 兜底：python-docx 会一次性读完整个包，不需要 with 管理 BytesIO
+    doc = DocReader(src if isinstance(src, str) else BytesIO(src))
+    return "\n".join(p.text for p in doc.paragraphs)
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_pool() -> ProcessPoolExecutor:
+    # 进程池常驻，避免每次都重新拉起子进程
+    pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()  # 子进程在第一次提交时才 fork，这里立刻把它们拉起来
+    return pool
+
+# 在脚本线程里、本应用自己的下载/解析等线程启动之前就 fork 好子进程，减少子进程继承到被占用的锁的机会。
+# Streamlit 的 server 线程此时已经在跑，fork 并不能因此变得完全安全
+if PDF_PARALLEL:
+    get_pdf_pool()
+
+# 子进程一旦崩溃（比如 MuPDF 碰上损坏的 PDF），进程池就永远是 BrokenProcessPool。
+# 不在解析线程里重新 fork，之后所有会话的长 PDF 都改走串行
+@st.cache_resource(show_spinner=False)
+def pdf_pool_state() -> dict:
+    return {"broken": False}
+
+@st.cache_resource(show_spinner=False)
+def pick_pdf_backend() -> str:
+    # 启动时用一页的样例跑一次基准，选出本机上最快的 PDF 解析库，之后一直沿用
+    return fastest_pdf_backend()
+
+def extract_text_from_pdf(src, backend="pymupdf"):
+    # 路径直接交给解析库读文件；bytes 不再经 BytesIO 复制
+    with open_pdf(src, backend) as (n, text_range):
+        if n <= PDF_PARALLEL_MIN_PAGES or not PDF_PARALLEL or pdf_pool_state()["broken"]:
+            return text_range(0, n)
+
+    if not isinstance(src, bytes):
+        return extract_pages_in_pool(src, n, backend)
+    # 上传的 bytes 先落一次盘，子进程按路径读，不必把整份 PDF 给每个页段各 pickle 一份
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(src)
+    try:
+        return extract_pages_in_pool(f.name, n, backend)
+    finally:
+        os.remove(f.name)
+
+def extract_pages_in_pool(path, n, backend):
+    step = -(-n // PDF_WORKERS)
+    starts = list(range(0, n, step))
+    stops = [min(i + step, n) for i in starts]
+    try:
+        parts = get_pdf_pool().map(extract_page_range, [path] * len(starts), starts, stops, [backend] * len(starts))
+        return "".join(parts)
+    except BrokenProcessPool:
+        pdf_pool_state()["broken"] = True
+    with open_pdf(path, backend) as (_, text_range):
+        return text_range(0, n)
+
+# 同样的文件字节只解析一次（Streamlit 每次交互都会重跑整个脚本）
+@st.cache_data(show_spinner=False, max_entries=64)
 def extract_text_from_docx_bytes(file_bytes):
-    with BytesIO(file_bytes) as f:
-        doc = DocReader(f)
-        return "\n".join(p.text for p in doc.paragraphs)
-
-def extract_text_from_pdf_bytes(file_bytes):
-    with BytesIO(file_bytes) as f:
-        doc = fitz.open(stream=f.read(), filetype="pdf")
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
-
-def ask_gpt(prompt: str) -> str:
-    resp = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[
-            {"role": "system", "content": "You are an assistant helping QA Commons extract and format EEQs."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.2,
-    )
+    return extract_text_from_docx(file_bytes)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_text_from_pdf_bytes(file_bytes, backend="pymupdf"):
+    return extract_text_from_pdf(file_bytes, backend)
+
+def extract_text(name, src, pdf_backend="pymupdf"):
+    is_docx = name.lower().endswith(".docx")
+    if isinstance(src, bytes):
+        return extract_text_from_docx_bytes(src) if is_docx else extract_text_from_pdf_bytes(src, pdf_backend)
+    return extract_text_from_docx(src) if is_docx else extract_text_from_pdf(src, pdf_backend)
+
+SYSTEM_MESSAGE = {"role": "system", "content": "You are an assistant helping QA Commons extract and format EEQs."}
+
+def build_chat_body(prompt: str) -> dict:
+    """chat.completions 的请求体；实时调用和 Batch API 共用。system 消息是共享常量，只换 user 内容。"""
+    return {
+        "model": MODEL_NAME,
+        "messages": [SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+        "temperature": 0.2,
+    }
+
+async def ask_gpt(prompt: str) -> str:
+    resp = await client.chat.completions.create(**build_chat_body(prompt))
     return resp.choices[0].message.content
 
+# ===== 多份大纲打包 =====
+PACKED_BLOCK_RE = re.compile(r"<<FILE_(\d+)>>(.*?)<</FILE_\1>>", re.S)
+
+@st.cache_resource(show_spinner=False)
+def get_encoder():
+    return tiktoken.encoding_for_model(MODEL_NAME)
+
+def encode(text: str):
+    # 大纲里偶尔会出现 "<|endoftext|>" 之类的字面量，按普通文本编码
+    return get_encoder().encode(text, disallowed_special=())
+
+def count_tokens(text: str) -> int:
+    return len(encode(text))
+
+def syllabus_token_budget(base_prompt_tokens: int) -> int:
+    budget = min(SYLLABUS_MAX_TOKENS, MAX_PROMPT_TOKENS - base_prompt_tokens)
+    if budget <= 0:
+        raise ValueError(f"Prompt 本身已有 {base_prompt_tokens} tokens，超过上限 {MAX_PROMPT_TOKENS}，放不下大纲正文。")
+    return budget
+
+def trim_to_budget(text: str, budget: int):
+    """超出 budget 时保留前后各一半 token，返回 (text, token 数)。"""
+    ids = encode(text)
+    if len(ids) <= budget:
+        return text, len(ids)
+    k = budget // 2
+    return get_encoder().decode(ids[:k] + ids[len(ids) - k:]), 2 * k
+
+def pack_is_full(pack_len, pack_tokens, n_tokens) -> bool:
+    """当前组再放一份 n_tokens 的大纲是否超出预算。空组总能放下，单份超预算的大纲自成一组。"""
+    return pack_len > 0 and (pack_tokens + n_tokens > PACK_TOKEN_BUDGET or pack_len >= PACK_MAX_FILES)
+
+def pack_syllabi(token_counts):
+    """按 token 预算贪心分组，返回 [[输入序号, ...], ...]。"""
+    packs, cur, cur_tokens = [], [], 0
+    for idx, n in enumerate(token_counts):
+        if pack_is_full(len(cur), cur_tokens, n):
+            packs.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(idx)
+        cur_tokens += n
+    if cur:
+        packs.append(cur)
+    return packs
+
+SINGLE_PROMPT_SUFFIX = (
+    "\n\n---\n\nNow analyze the following course syllabus and generate the EEQ extraction "
+    "in the same format as above.\n\nCourse Syllabus:\n\n"
+)
+PACKED_PROMPT_SUFFIX = (
+    "\n\n---\n\nNow analyze each of the following course syllabi separately and generate the EEQ "
+    "extraction for each one in the same format as above.\n"
+    "Each syllabus is enclosed between ===DOC id=FILE_k=== and ===END id=FILE_k===. "
+    "Wrap the extraction for FILE_k between <<FILE_k>> and <</FILE_k>> (one block per syllabus) "
+    "and write nothing outside these blocks.\n\nCourse Syllabi:\n\n"
+)
+
+def prompt_prefixes(base_prompt: str):
+    """(单份前缀, 多份前缀)。每次运行只拼一次，循环里直接拼接大纲正文。"""
+    base = base_prompt.strip()
+    return base + SINGLE_PROMPT_SUFFIX, base + PACKED_PROMPT_SUFFIX
+
+def build_pack_prompt(prefixes, syllabus_texts) -> str:
+    """只有一份大纲时沿用原来的单文件格式；多份时用分隔符包起来，并要求按 FILE_k 分块输出。"""
+    single_prefix, packed_prefix = prefixes
+    if len(syllabus_texts) == 1:
+        return single_prefix + syllabus_texts[0]
+    parts = [packed_prefix]
+    for k, text in enumerate(syllabus_texts):
+        parts.append(f"===DOC id=FILE_{k}===\n{text}\n===END id=FILE_{k}===\n\n")
+    return "".join(parts)
+
+def split_pack_output(pack, output):
+    """把一组的回复拆成 {输入序号: 输出}；没解析到的文件为 None。"""
+    if len(pack) == 1:
+        return {pack[0]: output}
+    blocks = {int(k): body.strip() for k, body in PACKED_BLOCK_RE.findall(output or "")}
+    return {idx: blocks.get(k) for k, idx in enumerate(pack)}
+
+def unpack_outputs(packs, outputs, n_files):
+    """把每组的回复拆回各文件，顺序与输入一致；没解析到的文件为 None。"""
+    per_file = [None] * n_files
+    for pack, output in zip(packs, outputs):
+        for idx, out in split_pack_output(pack, output).items():
+            per_file[idx] = out
+    return per_file
+
+# ===== OpenAI Batch API =====
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+async def submit_batch(prompts) -> str:
+    """把所有 prompt 写成 JSONL 上传并创建批任务，返回 batch id。custom_id 用组序号，避免重名文件冲突。"""
+    lines = [
+        json.dumps(
+            {"custom_id": f"pack-{idx}", "method": "POST", "url": BATCH_ENDPOINT, "body": build_chat_body(p)},
+            ensure_ascii=False,
+        )
+        for idx, p in enumerate(prompts)
+    ]
+    jsonl = ("\n".join(lines) + "\n").encode("utf-8")
+    batch_file = await client.files.create(file=("eeq_batch.jsonl", BytesIO(jsonl)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    return batch.id
+
+async def collect_batch(batch_id: str):
+    """返回 (status, {custom_id: output})；批任务未完成时 outputs 为 None。"""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return batch.status, None
+
+    outputs = {}
+    if batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            resp = item.get("response") or {}
+            if resp.get("status_code") == 200:
+                outputs[item["custom_id"]] = resp["body"]["choices"][0]["message"]["content"]
+    return batch.status, outputs
+
+# ===== 结果缓存 =====
+# 同一份大纲 + 同一个 prompt 只调用一次 GPT；落盘后跨 rerun、跨会话都能直接复用
+@st.cache_resource(show_spinner=False)
+def get_result_cache() -> diskcache.Cache:
+    return diskcache.Cache(RESULT_CACHE_DIR)
+
+def file_digest(src) -> str:
+    """blake2b 内容摘要；src 为 bytes 或文件路径（按块读取，不整体载入内存）。"""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(src, bytes):
+        h.update(src)
+    else:
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def result_key(file_hash: str, prompt_hash: str) -> str:
+    return f"{MODEL_NAME}:{prompt_hash}:{file_hash}"
+
+# memo 是会话内的内存层（st.session_state["gpt_cache"]），挡在磁盘缓存前面
+def get_cached_result(memo, key):
+    output = memo.get(key)
+    if output is None:
+        output = get_result_cache().get(key)
+        if output is not None:
+            memo[key] = output
+    return output
+
+def set_cached_result(memo, key, output):
+    memo[key] = output
+    get_result_cache().set(key, output)
+
+# ===== 处理流水线 =====
+async def run_pipeline(dropbox_targets, uploads, base_prompt=None, budget=None, pdf_backend="pymupdf", memo=None, on_parsed=None, on_answered=None):
+    """下载 → 解析 → 打包 → GPT 四段流水线，段与段之间用有界队列衔接，
+    稳态吞吐取决于最慢的一段而不是各段之和。已有缓存结果的文件下载后直接跳过解析和 GPT；
+    同一次运行里内容相同的文件只处理第一份，结束时再把文本和结果复制给其余几份。
+
+    dropbox_targets 为 [(name, dropbox_path)]，uploads 为 [(name, bytes)]。
+    base_prompt 为 None 时只下载和解析（批量模式用）；否则 budget 为调用方已算好的单份大纲 token 上限。
+    memo 为会话内的结果缓存 dict（脚本线程之外不能访问 st.session_state，由调用方传入）。
+    返回 (names, texts, outputs, hashes)，均与输入同序。
+    """
+    loop = asyncio.get_running_loop()
+    names = [name for name, _ in dropbox_targets] + [name for name, _ in uploads]
+    texts = [None] * len(names)
+    outputs = [None] * len(names)
+    hashes = [None] * len(names)
+    parse_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    pack_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    gpt_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    download_sem = asyncio.Semaphore(DOWNLOAD_WORKERS)
+    # 事件循环由所有会话共用：下载、摘要、磁盘缓存读写等阻塞调用都放进线程池
+    io_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    parse_pool = ThreadPoolExecutor(max_workers=1)
+    memo = {} if memo is None else memo
+    first_of = {}  # file_hash -> 本次运行中第一次出现的 idx
+    prompt_hash = file_digest(base_prompt.encode("utf-8")) if base_prompt is not None else None
+    answered = 0
+
+    def mark_answered(n):
+        nonlocal answered
+        answered += n
+        if on_answered:
+            on_answered(answered)
+
+    async def route(idx, name, src, file_hash):
+        hashes[idx] = file_hash
+        if file_hash in first_of:
+            if isinstance(src, str):
+                os.remove(src)
+            mark_answered(1)
+            return
+        first_of[file_hash] = idx
+        if prompt_hash is not None:
+            cached = await loop.run_in_executor(io_pool, get_cached_result, memo, result_key(file_hash, prompt_hash))
+            if cached is not None:
+                outputs[idx] = cached
+                if isinstance(src, str):
+                    os.remove(src)
+                mark_answered(1)
+                return
+        await parse_q.put((idx, name, src))
+
+    async def download(idx, name, path, tmp_dir, dbx):
+        local_path = os.path.join(tmp_dir, f"{idx}{os.path.splitext(name)[1]}")
+        async with download_sem:
+            await loop.run_in_executor(io_pool, download_dropbox_file, dbx, path, local_path)
+            file_hash = await loop.run_in_executor(io_pool, file_digest, local_path)
+        await route(idx, name, local_path, file_hash)
+
+    async def produce(tmp_dir):
+        offset = len(dropbox_targets)
+        for idx, (name, data) in enumerate(uploads, start=offset):
+            await route(idx, name, data, await loop.run_in_executor(io_pool, file_digest, data))
+        if dropbox_targets:
+            dbx = await loop.run_in_executor(io_pool, get_dbx)  # 缓存过期时会联网重新鉴权
+            await asyncio.gather(*(
+                download(idx, name, path, tmp_dir, dbx)
+                for idx, (name, path) in enumerate(dropbox_targets)
+            ))
+        await parse_q.put(None)
+
+    # prompt 前缀只拼一次
+    if base_prompt is not None:
+        prefixes = prompt_prefixes(base_prompt)
+
+    def parse_one(name, src):
+        text = extract_text(name, src, pdf_backend)
+        if base_prompt is None:
+            return text, None
+        # 整篇正文的 tiktoken 编码也在解析线程里做，不占事件循环
+        return trim_to_budget(text, budget)
+
+    # PyMuPDF / pdfium 都不支持多线程，解析段只用一个线程
+    async def parse():
+        while (item := await parse_q.get()) is not None:
+            idx, name, src = item
+            texts[idx], n = await loop.run_in_executor(parse_pool, parse_one, name, src)
+            if isinstance(src, str):
+                os.remove(src)  # 解析完立即删除临时文件
+            if on_parsed:
+                on_parsed(name)
+            await pack_q.put((idx, n))
+        await pack_q.put(None)
+
+    async def pack():
+        cur, cur_tokens = [], 0
+        while (item := await pack_q.get()) is not None:
+            if base_prompt is None:
+                continue
+            idx, n = item
+            if pack_is_full(len(cur), cur_tokens, n):
+                await gpt_q.put(cur)
+                cur, cur_tokens = [], 0
+            cur.append(idx)
+            cur_tokens += n
+        if cur:
+            await gpt_q.put(cur)
+        for _ in range(GPT_CONCURRENCY):
+            await gpt_q.put(None)
+
+    async def answer():
+        while (pack_ids := await gpt_q.get()) is not None:
+            output = await ask_gpt(build_pack_prompt(prefixes, [texts[i] for i in pack_ids]))
+            for idx, out in split_pack_output(pack_ids, output).items():
+                # 打包回复里缺块的文件，单独再问一次
+                if out is None:
+                    out = await ask_gpt(build_pack_prompt(prefixes, [texts[idx]]))
+                outputs[idx] = out
+                await loop.run_in_executor(io_pool, set_cached_result, memo, result_key(hashes[idx], prompt_hash), out)
+            mark_answered(len(pack_ids))
+
+    # 出错时在途的下载可能还要等到超时，临时目录删不干净也不影响结果
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp_dir:
+        tasks = [
+            asyncio.create_task(produce(tmp_dir)),
+            asyncio.create_task(parse()),
+            asyncio.create_task(pack()),
+            *(asyncio.create_task(answer()) for _ in range(GPT_CONCURRENCY)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+        finally:
+            # 不在共用的事件循环上等线程池收尾（shutdown(wait=True) 会卡住其他会话的 GPT 请求）
+            io_pool.shutdown(wait=False, cancel_futures=True)
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+    for idx, file_hash in enumerate(hashes):
+        first = first_of[file_hash]
+        if first != idx:
+            texts[idx], outputs[idx] = texts[first], outputs[first]
+    return names, texts, outputs, hashes
+
+@st.cache_data(show_spinner=False)
 def read_txt(path):
     if not os.path.exists(path):
         st.error(f"Prompt 文件不存在：{path}"); st.stop()
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
+# ===== Word 输出 =====
+# 结果文档是只写的扁平结构（标题 + 正文 + 分页），直接拼 WordprocessingML 再打 zip，
+# 不经过 python-docx 的对象树
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '</Types>'
+)
+DOCX_PACKAGE_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+DOCX_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+DOCX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    f'<w:styles xmlns:w="{W_NS}">'
+    '<w:docDefaults><w:rPrDefault><w:rPr>'
+    '<w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:cs="Calibri"/><w:sz w:val="22"/>'
+    '</w:rPr></w:rPrDefault></w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/>'
+    '<w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>'
+    '<w:pPr><w:keepNext/><w:spacing w:before="480" w:after="120"/><w:outlineLvl w:val="0"/></w:pPr>'
+    '<w:rPr><w:b/><w:color w:val="365F91"/><w:sz w:val="28"/></w:rPr></w:style>'
+    '</w:styles>'
+)
+DOCX_PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+DOCX_SECTION = (
+    '<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+    '<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="720" w:footer="720" w:gutter="0"/>'
+    '</w:sectPr>'
+)
+# 结果文件下载后只打开一次：zlib 1 级比默认 6 级快数倍，体积只大一成左右
+DOCX_COMPRESSLEVEL = 1
+# XML 1.0 不允许的控制字符（模型输出里偶尔会带）
+XML_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def docx_text(text: str) -> str:
+    return escape(XML_ILLEGAL_RE.sub("", text))
+
+def docx_paragraph(text: str, style: str = None) -> str:
+    # 与 python-docx 的 add_paragraph 一致：换行写成同一段落里的 <w:br/>
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    lines = "<w:br/>".join(
+        f'<w:t xml:space="preserve">{docx_text(line)}</w:t>' for line in text.split("\n")
+    )
+    return f"<w:p>{ppr}<w:r>{lines}</w:r></w:p>"
+
 def write_output_to_word(results):
-    doc = DocWriter()
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>', f'<w:document xmlns:w="{W_NS}"><w:body>']
     for filename, output in results:
-        doc.add_heading(f"EEQ Output for {filename}", level=1)
-        doc.add_paragraph(output)
-        doc.add_page_break()
+        parts.append(docx_paragraph(f"EEQ Output for {filename}", style="Heading1"))
+        parts.append(docx_paragraph(output or ""))
+        parts.append(DOCX_PAGE_BREAK)
+    parts.append(DOCX_SECTION + "</w:body></w:document>")
+
     buf = BytesIO()
-    doc.save(buf); buf.seek(0)
-    return buf
+    with zipfile.ZipFile(buf, "w") as z:
+        # 几个固定的小部件不值得压缩，原样存入
+        z.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES, zipfile.ZIP_STORED)
+        z.writestr("_rels/.rels", DOCX_PACKAGE_RELS, zipfile.ZIP_STORED)
+        z.writestr("word/_rels/document.xml.rels", DOCX_DOCUMENT_RELS, zipfile.ZIP_STORED)
+        z.writestr("word/styles.xml", DOCX_STYLES, zipfile.ZIP_STORED)
+        z.writestr("word/document.xml", "".join(parts), zipfile.ZIP_DEFLATED, DOCX_COMPRESSLEVEL)
+    return buf.getvalue()
+
+def offer_download(results):
+    """生成 Word 文件并存进 session_state，之后的 rerun（包括点下载按钮）都不用重新处理。"""
+    st.session_state.download = {
+        "data": write_output_to_word(results),
+        "file_name": f"EEQ_Output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx",
+    }
+
+def show_download():
+    if "download" not in st.session_state:
+        return
+    st.success("Processing completed!")
+    st.download_button(
+        label="Download Results",
+        data=st.session_state.download["data"],
+        file_name=st.session_state.download["file_name"],
+        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    )
 
 # ===== UI =====
 st.title("EEQ Syllabus Processor")
@@ -181,13 +786,17 @@ st.subheader("Step 0: Choose a Dropbox folder")
 if "cwd" not in st.session_state:
     st.session_state.cwd = DEFAULT_START_FOLDER
 
-col1, col2 = st.columns([3, 1])
+col1, col2, col3 = st.columns([3, 1, 1])
 with col1:
     new_path = st.text_input("Current path", value=st.session_state.cwd, key="cwd_input")
 with col2:
     if st.button("Go"):
         st.session_state.cwd = new_path or "/"
         st.rerun()
+with col3:
+    if st.button("Refresh", help="Fetch changes made in Dropbox since the folder tree was loaded."):
+        load_tree(refresh=True)
+        st.rerun()
 
 folders = list_dropbox_folders(st.session_state.cwd)
 options = [".. (parent directory)"] + [f"{name} — {path}" for name, path in folders]
@@ -226,59 +835,171 @@ uploaded_files = st.file_uploader(
 
 # Step 2: 处理
 st.subheader("Step 2: Run")
-run_clicked = st.button("Start Processing")
-
-if run_clicked:
-    # 1) 合并两种来源的文件到统一结构：[(name, bytes), ...]
-    combined_inputs = []
-
-    # 从 Dropbox 下载被选中的文件
-    if selected_dropbox_files:
-        st.info("Downloading from Dropbox...")
-        combined_inputs.extend(download_dropbox_files(files, selected_dropbox_files))
-
-    # 加入本地上传的文件
-    if uploaded_files:
-        for up in uploaded_files:
-            combined_inputs.append((up.name, up.read()))
-
-    if not combined_inputs:
+batch_mode = st.checkbox(
+    "Batch mode (OpenAI Batch API: 50% cheaper, results within 24h)",
+    help="Submit all syllabi as one batch job, then come back and click 'Collect results'.",
+)
+pdf_backend = st.selectbox(
+    "PDF backend",
+    PDF_BACKENDS,
+    index=PDF_BACKENDS.index(pick_pdf_backend()),
+    help="Library used to extract text from PDFs. Defaults to whichever was faster in a startup benchmark.",
+)
+# 上一次的任务还在后台跑时不接受重复点击
+job = st.session_state.get("job")
+running = job is not None and not job["future"].done()
+run_clicked = st.button("Start Processing", disabled=running)
+
+if run_clicked and not running:
+    # 1) 合并两种来源的文件：Dropbox 选中的 [(name, path)] 与本地上传的 [(name, bytes)]
+    selected = set(selected_dropbox_files)
+    dropbox_targets = [(name, path) for name, path in files if name in selected]
+    uploads = [(up.name, up.read()) for up in (uploaded_files or [])]
+
+    if not dropbox_targets and not uploads:
         st.warning("Please select at least one Dropbox file or upload local files.")
         st.stop()
+    # 同一时间只保留一个批量任务，否则新的会覆盖还没取回的那个
+    if batch_mode and "batch" in st.session_state:
+        st.warning("A batch is still pending. Collect its results in Step 3 before submitting another.")
+        st.stop()
 
-    # 2) 读取 Prompt
+    # 2) 读取 Prompt；base prompt 只在这里编码一次，本身就超长时直接报错，不去下载和解析
     base_prompt = read_txt(PROMPT_PATH)
-
-    # 3) 逐个处理
-    st.info("Processing files...")
-    results = []
-    progress = st.progress(0)
-
-    for idx, (name, content) in enumerate(combined_inputs):
-        st.write(f"Processing: {name}")
-        if name.lower().endswith(".docx"):
-            syllabus_text = extract_text_from_docx_bytes(content)
-        else:
-            syllabus_text = extract_text_from_pdf_bytes(content)
-
-        full_prompt = (
-            base_prompt.strip()
-            + "\n\n---\n\nNow analyze the following course syllabus and generate the EEQ extraction "
-            + "in the same format as above.\n\nCourse Syllabus:\n\n"
-            + syllabus_text
+    try:
+        budget = syllabus_token_budget(count_tokens(base_prompt))
+    except ValueError as e:
+        st.error(str(e)); st.stop()
+
+    # 3) 下载、解析、打包、调用 GPT 流水线放到后台事件循环上跑，脚本线程只负责刷新进度
+    events = queue.Queue()
+    job = start_job(
+        run_pipeline(
+            dropbox_targets,
+            uploads,
+            base_prompt=None if batch_mode else base_prompt,
+            budget=budget,
+            pdf_backend=pdf_backend,
+            memo=st.session_state.setdefault("gpt_cache", {}),
+            on_parsed=lambda name: events.put(("parsed", name)),
+            on_answered=lambda done: events.put(("answered", done)),
+        ),
+        events,
+        len(dropbox_targets) + len(uploads),
+    )
+    job["batch_mode"] = batch_mode
+    job["base_prompt"] = base_prompt
+    job["budget"] = budget
+    st.session_state.job = job
+
+# 任务存在 session_state 里：中途 rerun 只会重画进度、接着等，不会重新开始
+if "job" in st.session_state:
+    job = st.session_state.job
+    with st.status(f"Processing... {job['done']}/{job['total']}", expanded=True) as status:
+        progress = st.progress(job["done"] / job["total"])
+        for name in job["parsed"]:
+            st.write(f"Processing: {name}")
+
+        def on_event(kind, value):
+            if kind == "parsed":
+                job["parsed"].append(value)
+                st.write(f"Processing: {value}")
+            else:
+                job["done"] = value
+                progress.progress(value / job["total"])
+                status.update(label=f"Processing... {value}/{job['total']}")
+
+        wait_job(job, on_event)
+        failed = job["future"].exception() is not None
+        status.update(
+            label="Processing failed" if failed else f"Processed {job['total']} files",
+            state="error" if failed else "complete",
+            expanded=False,
         )
-        output = ask_gpt(full_prompt)
-        results.append((name, output))
-        progress.progress((idx + 1) / len(combined_inputs))
+    del st.session_state.job
+
+    try:
+        names, texts, outputs, hashes = job["future"].result()
+    except AuthError:
+        get_dbx.clear()
+        st.error("Dropbox 认证失败（下载阶段）。"); st.stop()
+    except ApiError as e:
+        st.error(f"Dropbox API 错误：{e}"); st.stop()
+    except Exception as e:
+        st.error(f"处理失败：{e}"); st.stop()
+
+    # 批量模式：提交后先返回，稍后用 "Collect results" 取回
+    if job["batch_mode"]:
+        base_prompt, budget = job["base_prompt"], job["budget"]
+        prompt_hash = file_digest(base_prompt.encode("utf-8"))
+        memo = st.session_state.setdefault("gpt_cache", {})
+        # 内容相同的文件只看一份；已有缓存结果的不再提交（否则会重复计费），取回时按 hash 分给每个文件
+        first_of = {}
+        for i, h in enumerate(hashes):
+            first_of.setdefault(h, i)
+        cached, todo = {}, []
+        for h, i in first_of.items():
+            out = get_cached_result(memo, result_key(h, prompt_hash))
+            if out is None:
+                todo.append(i)
+            else:
+                cached[h] = out
+        if todo:
+            texts, token_counts = zip(*(trim_to_budget(texts[i], budget) for i in todo))
+            packs = pack_syllabi(token_counts)
+            prefixes = prompt_prefixes(base_prompt)
+            prompts = [build_pack_prompt(prefixes, [texts[i] for i in pack]) for pack in packs]
+            batch_id = run_async(submit_batch(prompts))
+            st.session_state.batch = {
+                "id": batch_id,
+                "names": names,
+                "packs": packs,
+                "hashes": hashes,
+                "submitted_hashes": [hashes[i] for i in todo],
+                "cached": cached,
+                "prompt_hash": prompt_hash,
+            }
+            st.success(f"Batch submitted: {batch_id}. Click 'Collect results' once it has completed.")
+            st.stop()
+        # 全部命中缓存，不用提交批量任务
+        outputs = [cached[h] for h in hashes]
+
+    results = list(zip(names, outputs))
 
     # 4) 打包下载
-    buf = write_output_to_word(results)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_name = f"EEQ_Output_{ts}.docx"
-    st.success("Processing completed!")
-    st.download_button(
-        label="Download Results",
-        data=buf,
-        file_name=out_name,
-        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-    )
+    offer_download(results)
+
+# Step 3: 取回批量任务结果
+if "batch" in st.session_state:
+    st.subheader("Step 3: Collect batch results")
+    batch_info = st.session_state.batch
+    st.caption(f"Pending batch: {batch_info['id']} ({len(batch_info['names'])} files)")
+    if st.button("Collect results"):
+        try:
+            status, outputs = run_async(collect_batch(batch_info["id"]))
+        except Exception as e:
+            st.error(f"取回批量结果失败：{e}"); st.stop()
+        if status in BATCH_FAILED_STATUSES:
+            st.error(f"Batch {status}. Please resubmit.")
+            del st.session_state.batch
+        elif outputs is None:
+            st.info(f"Batch status: {status}. Please check back later.")
+        else:
+            pack_outputs = [outputs.get(f"pack-{i}") for i in range(len(batch_info["packs"]))]
+            per_file = unpack_outputs(batch_info["packs"], pack_outputs, len(batch_info["submitted_hashes"]))
+            by_hash = dict(zip(batch_info["submitted_hashes"], per_file))
+            memo = st.session_state.setdefault("gpt_cache", {})
+            for file_hash, out in by_hash.items():
+                if out is not None:
+                    set_cached_result(memo, result_key(file_hash, batch_info["prompt_hash"]), out)
+            by_hash.update(batch_info["cached"])  # 提交前就命中缓存的文件
+            results = [
+                (name, by_hash[h] if by_hash[h] is not None else "（该文件在批量任务中未返回结果）")
+                for name, h in zip(batch_info["names"], batch_info["hashes"])
+            ]
+            offer_download(results)
+            del st.session_state.batch  # 结果已交付，rerun 后不再显示 Step 3
+            st.rerun()
+
+# 最近一次的结果：存在 session_state 里，rerun 后下载按钮仍在
+show_download()
@@ -0,0 +1,66 @@
+# PDF 逐页取文本。单独成模块，ProcessPoolExecutor 的子进程才能按模块名导入这里的函数
+# （Streamlit 脚本本身不能被子进程 import）。
+import time
+import threading
+from contextlib import contextmanager
+
+import fitz  # PyMuPDF
+import pypdfium2 as pdfium
+
+PDF_BACKENDS = ("pymupdf", "pypdfium2")
+
+# pdfium 不能被两个线程同时调用（即使是不同文档）；各会话的解析线程、启动基准都要先拿这把锁
+PDFIUM_LOCK = threading.Lock()
+
+# PDF 只取纯文本：保留空白，裁掉页面可见区域以外的文字
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+def page_text(page) -> str:
+    return page.get_text("text", sort=False, flags=PDF_TEXT_FLAGS)
+
+def pdfium_page_text(doc, i: int) -> str:
+    page = doc[i]
+    textpage = page.get_textpage()
+    try:
+        # 与 PyMuPDF 的输出对齐：统一换行符，每页以换行结尾
+        return textpage.get_text_range().replace("\r\n", "\n") + "\n"
+    finally:
+        textpage.close()
+        page.close()
+
+@contextmanager
+def open_pdf(src, backend: str = "pymupdf"):
+    """按 backend 打开 PDF，yield (页数, text_range)；text_range(start, stop) 返回 [start, stop) 页的文本。
+    src 为路径时直接读文件，为 bytes 时从内存打开。"""
+    if backend == "pypdfium2":
+        with PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(src)
+            try:
+                yield len(doc), lambda start, stop: "".join(pdfium_page_text(doc, i) for i in range(start, stop))
+            finally:
+                doc.close()
+    else:
+        doc = fitz.open(src) if isinstance(src, str) else fitz.open(stream=src, filetype="pdf")
+        with doc:
+            yield doc.page_count, lambda start, stop: "".join(page_text(doc.load_page(i)) for i in range(start, stop))
+
+def extract_page_range(src, start: int, stop: int, backend: str = "pymupdf") -> str:
+    """在子进程里重新打开文档，提取 [start, stop) 页的文本。"""
+    with open_pdf(src, backend) as (_, text_range):
+        return text_range(start, stop)
+
+def fastest_pdf_backend(repeat: int = 5) -> str:
+    """用一页的小样例 PDF 给各 backend 计时（取最好成绩），返回最快的那个。"""
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), "Course Syllabus\nLearning Outcomes\nAssessment")
+        sample = doc.tobytes()
+
+    def best_time(backend):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            extract_page_range(sample, 0, 1, backend)
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    return min(PDF_BACKENDS, key=best_time)